@@ -36,6 +36,9 @@ use crate::{
     ResourceIdx,
 };
 
+/// Filenames a path component may take when the solver picks path arguments.
+const COMPONENT_ALPHABET: &[&str] = &["a", "b", "c", "d", "e", "f", "g", ".", ".."];
+
 #[derive(Clone, Debug)]
 struct State {
     preopens:  IndexSpace<ResourceIdx, PreopenFs>,
@@ -215,7 +218,7 @@ impl State {
 
     fn declare<'ctx>(
         &self,
-        mut aop: ArbitraryOrPresolved<'_, '_>,
+        aop: ArbitraryOrPresolved<'_, '_>,
         spec: &Spec,
         ctx: &'ctx z3::Context,
         types: &'ctx StateTypes<'ctx>,
@@ -223,6 +226,22 @@ impl State {
         function: &Function,
         contract: Option<&Term>,
     ) -> StateDecls<'ctx> {
+        let (preopens, resources) = self.declare_state(ctx, types, env);
+
+        self.declare_call(aop, spec, ctx, types, function, contract, preopens, resources)
+    }
+
+    // Declares the preopened file systems and the resources, which don't depend on the function
+    // being called.
+    fn declare_state<'ctx>(
+        &self,
+        ctx: &'ctx z3::Context,
+        types: &'ctx StateTypes<'ctx>,
+        env: &Environment,
+    ) -> (
+        BTreeMap<ResourceIdx, PreopenFsEncoding<'ctx>>,
+        BTreeMap<ResourceIdx, Dynamic<'ctx>>,
+    ) {
         let mut preopens = BTreeMap::default();
         let mut resources = BTreeMap::new();
 
@@ -247,6 +266,22 @@ impl State {
             );
         }
 
+        (preopens, resources)
+    }
+
+    // Declares the params and the primed values the contract solves for, on top of an already
+    // declared state.
+    fn declare_call<'ctx>(
+        &self,
+        mut aop: ArbitraryOrPresolved<'_, '_>,
+        spec: &Spec,
+        ctx: &'ctx z3::Context,
+        types: &'ctx StateTypes<'ctx>,
+        function: &Function,
+        contract: Option<&Term>,
+        preopens: BTreeMap<ResourceIdx, PreopenFsEncoding<'ctx>>,
+        resources: BTreeMap<ResourceIdx, Dynamic<'ctx>>,
+    ) -> StateDecls<'ctx> {
         let mut to_solves = ToSolves::default();
 
         if let Some(term) = &contract {
@@ -394,11 +429,29 @@ impl State {
         params: Option<&[HighLevelValue]>,
         results: Option<&[WasiValue]>,
         contract: Option<&Term>,
+    ) -> Bool<'ctx> {
+        Bool::and(
+            ctx,
+            &[
+                self.encode_state(ctx, types, &decls.preopens),
+                self.encode_call(
+                    ctx, env, types, decls, decls2, spec, function, params, results, contract,
+                ),
+            ],
+        )
+    }
+
+    // Encodes the preopened file systems. This holds regardless of the function being called.
+    fn encode_state<'ctx>(
+        &self,
+        ctx: &'ctx z3::Context,
+        types: &'ctx StateTypes<'ctx>,
+        preopens: &'ctx BTreeMap<ResourceIdx, PreopenFsEncoding<'ctx>>,
     ) -> Bool<'ctx> {
         let mut clauses = Vec::new();
         let mut all_files = Vec::new();
 
-        for (&_resource_idx, preopen) in decls.preopens.iter() {
+        for (&_resource_idx, preopen) in preopens.iter() {
             all_files.push(&preopen.root.node);
 
             let mut dirs = vec![&preopen.root];
@@ -416,11 +469,11 @@ impl State {
         }
 
         {
-            let mut all_dirs = decls.preopens.values().map(|preopen| &preopen.root.node).collect_vec();
+            let mut all_dirs = preopens.values().map(|preopen| &preopen.root.node).collect_vec();
             let mut all_files = vec![];
             let mut all_symlinks = vec![];
 
-            for (_idx, preopen) in decls.preopens.iter() {
+            for (_idx, preopen) in preopens.iter() {
                 let mut stack = vec![&preopen.root];
 
                 while let Some(dir) = stack.pop() {
@@ -469,10 +522,10 @@ impl State {
 
             // Assign IDs to all files.
 
-            let mut stack = decls.preopens.values().map(|p| &p.root).collect_vec();
+            let mut stack = preopens.values().map(|p| &p.root).collect_vec();
             let mut idx = 0;
 
-            for preopen in decls.preopens.values() {
+            for preopen in preopens.values() {
                 clauses.push(
                     types.file.variants[0].accessors[0]
                         .apply(&[&preopen.root.node])
@@ -522,6 +575,25 @@ impl State {
             }
         }
 
+        Bool::and(ctx, &clauses)
+    }
+
+    // Encodes the params and the contract of one call against an already encoded state.
+    fn encode_call<'ctx>(
+        &self,
+        ctx: &'ctx z3::Context,
+        env: &Environment,
+        types: &'ctx StateTypes<'ctx>,
+        decls: &'ctx StateDecls<'ctx>,
+        decls2: &'ctx StateDecls2<'ctx>,
+        spec: &Spec,
+        function: &Function,
+        params: Option<&[HighLevelValue]>,
+        results: Option<&[WasiValue]>,
+        contract: Option<&Term>,
+    ) -> Bool<'ctx> {
+        let mut clauses = Vec::new();
+
         // Constrain all the resource values.
         {
             clauses.push(Bool::and(
@@ -584,82 +656,29 @@ impl State {
             })
             .collect_vec();
 
-        // Segment components cannot be empty.
+        // Segment components are picked from a fixed, non-empty alphabet. Enumerating the choices
+        // keeps the string solver out of the way: no length or containment reasoning is needed.
+        let alphabet = COMPONENT_ALPHABET
+            .iter()
+            .map(|&name| z3::ast::String::from_str(ctx, name).unwrap())
+            .collect_vec();
+
         for &path in paths.iter() {
             clauses.push(Bool::and(
                 &ctx,
                 path.iter()
                     .enumerate()
                     .map(|(_i, segment)| {
-                        Bool::and(
+                        let segment_name = component.accessors[0].apply(&[segment]).as_string().unwrap();
+
+                        component.tester.apply(&[segment]).as_bool().unwrap().implies(&Bool::or(
                             ctx,
-                            &[&component
-                                .tester
-                                .apply(&[segment])
-                                .as_bool()
-                                .unwrap()
-                                .implies(&Bool::and(
-                                    ctx,
-                                    &[
-                                        &component.accessors[0]
-                                            .apply(&[segment])
-                                            .as_string()
-                                            .unwrap()
-                                            .length()
-                                            .gt(&Int::from_u64(ctx, 0)),
-                                        &Bool::or(
-                                            ctx,
-                                            &[
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "a").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "b").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "c").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "d").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "e").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "f").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "g").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, ".").unwrap()),
-                                                &component.accessors[0]
-                                                    .apply(&[segment])
-                                                    .as_string()
-                                                    .unwrap()
-                                                    ._eq(&z3::ast::String::from_str(ctx, "..").unwrap()),
-                                            ],
-                                        ),
-                                    ],
-                                ))],
-                        )
+                            alphabet
+                                .iter()
+                                .map(|name| segment_name._eq(name))
+                                .collect_vec()
+                                .as_slice(),
+                        ))
                     })
                     .collect_vec()
                     .as_slice(),
@@ -668,44 +687,33 @@ impl State {
 
         // Adjacent segments can't both be components or separators.
         for path in paths.iter() {
-            for (i, segment) in path.iter().enumerate().skip(1) {
-                let prev = path.get(i - 1).unwrap();
-
-                clauses.push(Bool::and(
-                    ctx,
-                    &[
-                        // separator
-                        //     .tester
-                        //     .apply(&[segment])
-                        //     .as_bool()
-                        //     .unwrap()
-                        //     .implies(&separator.tester.apply(&[prev]).as_bool().unwrap().not()),
-                        component
-                            .tester
-                            .apply(&[segment])
-                            .as_bool()
-                            .unwrap()
-                            .implies(&component.tester.apply(&[prev]).as_bool().unwrap().not()),
-                    ],
-                ));
+            let segments_are_component = path
+                .iter()
+                .map(|segment| component.tester.apply(&[segment]).as_bool().unwrap())
+                .collect_vec();
+
+            for i in 1..path.len() {
+                // separator
+                //     .tester
+                //     .apply(&[segment])
+                //     .as_bool()
+                //     .unwrap()
+                //     .implies(&separator.tester.apply(&[prev]).as_bool().unwrap().not()),
+                clauses.push(segments_are_component[i].implies(&segments_are_component[i - 1].not()));
             }
         }
 
         // Final segment should not be a separator.
         for path in paths.iter() {
-            clauses.push(Bool::and(
-                ctx,
-                &[separator
+            clauses.push(
+                separator
                     .tester
                     .apply(&[path.first().unwrap()])
                     .as_bool()
                     .unwrap()
-                    .not()],
-            ));
-            clauses.push(Bool::and(
-                ctx,
-                &[separator.tester.apply(&[path.last().unwrap()]).as_bool().unwrap().not()],
-            ));
+                    .not(),
+            );
+            clauses.push(separator.tester.apply(&[path.last().unwrap()]).as_bool().unwrap().not());
         }
 
         // Constrain non-resource param values.
@@ -2736,6 +2744,17 @@ impl<'ctx> StateTypes<'ctx> {
     }
 }
 
+// Simplifies the encoding before the SMT core sees it; `solve-eqs` substitutes away the ground equalities between
+// declared nodes. The whole pipeline reruns on every `check()`.
+fn preprocessing_solver<'ctx>(ctx: &'ctx z3::Context) -> z3::Solver<'ctx> {
+    ["propagate-values", "solve-eqs", "elim-uncnstr", "smt"]
+        .iter()
+        .fold(z3::Tactic::new(ctx, "simplify"), |tactic, name| {
+            tactic.and_then(&z3::Tactic::new(ctx, name))
+        })
+        .solver()
+}
+
 fn no_nonexistent_dir_backtrack<'ctx>(
     ctx: &'ctx z3::Context,
     types: &'ctx StateTypes<'ctx>,
@@ -2835,7 +2854,7 @@ fn no_nonexistent_dir_backtrack<'ctx>(
                             ctx,
                             &[
                                 &frame,
-                                &component.accessors[1]
+                                &component.accessors[0]
                                     .apply(&[segment])
                                     .as_string()
                                     .unwrap()
@@ -2848,13 +2867,13 @@ fn no_nonexistent_dir_backtrack<'ctx>(
                             ctx,
                             &[
                                 &frame,
-                                &component.accessors[1]
+                                &component.accessors[0]
                                     .apply(&[segment])
                                     .as_string()
                                     .unwrap()
                                     ._eq(&z3::ast::String::from_str(ctx, ".").unwrap())
                                     .not(),
-                                &component.accessors[1]
+                                &component.accessors[0]
                                     .apply(&[segment])
                                     .as_string()
                                     .unwrap()
@@ -2874,13 +2893,13 @@ fn no_nonexistent_dir_backtrack<'ctx>(
                                             ctx,
                                             &[
                                                 component.tester.apply(&[segment]).as_bool().unwrap(),
-                                                component.accessors[1]
+                                                component.accessors[0]
                                                     .apply(&[segment])
                                                     .as_string()
                                                     .unwrap()
                                                     ._eq(&z3::ast::String::from_str(ctx, ".").unwrap())
                                                     .not(),
-                                                component.accessors[1]
+                                                component.accessors[0]
                                                     .apply(&[segment])
                                                     .as_string()
                                                     .unwrap()
@@ -2963,7 +2982,7 @@ fn no_nonexistent_dir_backtrack<'ctx>(
                                     &[
                                         &frame,
                                         // filename matches segment.
-                                        &component.accessors[1]
+                                        &component.accessors[0]
                                             .apply(&[segment])
                                             .as_string()
                                             .unwrap()
@@ -2978,7 +2997,7 @@ fn no_nonexistent_dir_backtrack<'ctx>(
                                     &[
                                         &frame,
                                         // filename is `.`
-                                        &component.accessors[1]
+                                        &component.accessors[0]
                                             .apply(&[segment])
                                             .as_string()
                                             .unwrap()
@@ -2993,7 +3012,7 @@ fn no_nonexistent_dir_backtrack<'ctx>(
                                     &[
                                         &frame,
                                         // filename is `..`
-                                        &component.accessors[1]
+                                        &component.accessors[0]
                                             .apply(&[segment])
                                             .as_string()
                                             .unwrap()
@@ -3014,13 +3033,13 @@ fn no_nonexistent_dir_backtrack<'ctx>(
                                                     ctx,
                                                     &[
                                                         component.tester.apply(&[segment]).as_bool().unwrap(),
-                                                        component.accessors[1]
+                                                        component.accessors[0]
                                                             .apply(&[segment])
                                                             .as_string()
                                                             .unwrap()
                                                             ._eq(&z3::ast::String::from_str(ctx, ".").unwrap())
                                                             .not(),
-                                                        component.accessors[1]
+                                                        component.accessors[0]
                                                             .apply(&[segment])
                                                             .as_string()
                                                             .unwrap()
@@ -3100,43 +3119,60 @@ impl<'u, 'data, 'ctx> CallStrategy for StatefulStrategy<'u, 'data, 'ctx> {
     fn select_function<'spec>(&mut self, spec: &'spec Spec, env: &Environment) -> Result<&'spec Function, eyre::Error> {
         let interface = spec.interfaces.get_by_key("wasi_snapshot_preview1").unwrap();
         let mut candidates = Vec::new();
+        let mut state = State::new();
 
-        for (_name, function) in &interface.functions {
-            let mut state = State::new();
+        for (&idx, path) in &self.preopens {
+            state.push_preopen(idx, path);
+        }
 
-            for (&idx, path) in &self.preopens {
-                state.push_preopen(idx, path);
+        for (resource_type, resources) in &env.resources_by_types {
+            for &idx in resources {
+                state.push_resource(
+                    idx,
+                    spec.types.get_by_key(resource_type).unwrap(),
+                    env.resources.get(idx).unwrap().state.clone(),
+                );
             }
+        }
 
-            for (resource_type, resources) in &env.resources_by_types {
-                for &idx in resources {
-                    state.push_resource(
-                        idx,
-                        spec.types.get_by_key(resource_type).unwrap(),
-                        env.resources.get(idx).unwrap().state.clone(),
-                    );
-                }
-            }
+        // The state doesn't depend on the candidate function: declare and assert it once, and scope
+        // only each candidate's params and input contract so the solver keeps what it learned
+        // about the state across candidates.
+        let types = StateTypes::new(self.ctx, spec);
+        let (preopens, resources) = state.declare_state(self.ctx, &types, env);
+        let mut functions_decls = Vec::with_capacity(interface.functions.len());
 
-            let types = StateTypes::new(self.ctx, spec);
-            let decls = state.declare(
+        for (_name, function) in &interface.functions {
+            functions_decls.push(state.declare_call(
                 ArbitraryOrPresolved::Arbitrary(self.u),
                 spec,
                 self.ctx,
                 &types,
-                env,
                 function,
                 None,
-            );
-            let decls2 = state.declare2(&decls);
-            let solver = z3::Solver::new(self.ctx);
+                preopens.clone(),
+                resources.clone(),
+            ));
+        }
+
+        let functions_decls2 = functions_decls.iter().map(|decls| state.declare2(decls)).collect_vec();
+        let solver = z3::Solver::new(self.ctx);
+
+        solver.assert(&state.encode_state(self.ctx, &types, &preopens));
 
-            solver.assert(&state.encode(
+        for (((_name, function), decls), decls2) in interface
+            .functions
+            .iter()
+            .zip(functions_decls.iter())
+            .zip(functions_decls2.iter())
+        {
+            solver.push();
+            solver.assert(&state.encode_call(
                 self.ctx,
                 env,
                 &types,
-                &decls,
-                &decls2,
+                decls,
+                decls2,
                 spec,
                 function,
                 None,
@@ -3144,10 +3180,13 @@ impl<'u, 'data, 'ctx> CallStrategy for StatefulStrategy<'u, 'data, 'ctx> {
                 function.input_contract.as_ref(),
             ));
 
-            match solver.check() {
-                | z3::SatResult::Sat => candidates.push(function),
-                | _ => continue,
-            };
+            let result = solver.check();
+
+            solver.pop(1);
+
+            if result == z3::SatResult::Sat {
+                candidates.push(function);
+            }
         }
 
         let function = *self.u.choose(&candidates).wrap_err("failed to choose a function")?;
@@ -3340,7 +3379,7 @@ impl<'u, 'data, 'ctx> CallStrategy for StatefulStrategy<'u, 'data, 'ctx> {
             function.output_contract.as_ref(),
         );
         let decls2 = state.declare2(&decls);
-        let solver = z3::Solver::new(self.ctx);
+        let solver = preprocessing_solver(self.ctx);
 
         solver.assert(&state.encode(
             self.ctx,
@@ -3382,7 +3421,13 @@ impl<'u, 'data, 'ctx> CallStrategy for StatefulStrategy<'u, 'data, 'ctx> {
 
         match solver.check() {
             | z3::SatResult::Sat => (),
-            | _ => {
+            | z3::SatResult::Unknown => {
+                return Err(err!(
+                    "output contract solve returned unknown: {:?}",
+                    solver.get_reason_unknown()
+                ));
+            },
+            | z3::SatResult::Unsat => {
                 return Err(err!(
                     "failed to solve output contract {:?}",
                     std::thread::current().name()
@@ -3449,7 +3494,13 @@ impl<'u, 'data, 'ctx> CallStrategy for StatefulStrategy<'u, 'data, 'ctx> {
 
         match solver.check() {
             | z3::SatResult::Unsat => (),
-            | _ => {
+            | z3::SatResult::Unknown => {
+                return Err(err!(
+                    "output contract uniqueness check returned unknown: {:?}",
+                    solver.get_reason_unknown()
+                ));
+            },
+            | z3::SatResult::Sat => {
                 return Err(err!("more than one solution for output contract"));
             },
         }
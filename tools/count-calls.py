@@ -1,19 +1,290 @@
 #!/usr/bin/env python3
 
-import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
-wasm_files = glob(sys.argv[1])
-calls = 0
+# Same rule as counting `call $__imported_wasi_snapshot_preview1_*` lines in `wasm2wat` output: only calls to
+# functions carrying this name in the name section count.
+WASI_IMPORT_PREFIX = "__imported_wasi_snapshot_preview1_"
 
-for wasm_file in wasm_files:
-    wat = subprocess.run(["wasm2wat", "--enable-all", wasm_file], capture_output=True).stdout.decode("utf-8")
+WASM_MAGIC = b"\0asm"
+WASM_CORE_VERSION = b"\x01\0\0\0"
 
-    for line in wat.splitlines():
-        if not line.strip().startswith("call $__imported_wasi_snapshot_preview1_"):
-            continue
+SECTION_CUSTOM = 0
+SECTION_CODE = 10
 
-        calls += 1
+NAME_SUBSECTION_FUNCTIONS = 1
 
-print(calls)
+OP_CALL = 0x10
+
+# Single-byte opcodes without immediates outside the contiguous numeric range.
+OPS_WITHOUT_IMMEDIATES = {0x00, 0x01, 0x05, 0x0A, 0x0B, 0x0F, 0x19, 0x1A, 0x1B, 0xD1, 0xD3, 0xD4}
+
+# Reference type shorthands that are followed by a heap type (`ref ht` and `ref null ht`).
+REF_TYPES_WITH_HEAP_TYPE = (-0x1C, -0x1D)
+
+
+class Reader:
+    def __init__(self, data, pos=0, end=None):
+        self.data = data
+        self.pos = pos
+        self.end = len(data) if end is None else end
+
+    def byte(self):
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def skip(self, n):
+        self.pos += n
+
+    def uleb(self):
+        result = 0
+        shift = 0
+
+        while True:
+            b = self.byte()
+            result |= (b & 0x7F) << shift
+            shift += 7
+
+            if b & 0x80 == 0:
+                return result
+
+    def sleb(self):
+        result = 0
+        shift = 0
+
+        while True:
+            b = self.byte()
+            result |= (b & 0x7F) << shift
+            shift += 7
+
+            if b & 0x80 == 0:
+                if b & 0x40:
+                    result -= 1 << shift
+
+                return result
+
+    def name(self):
+        n = self.uleb()
+        s = bytes(self.data[self.pos : self.pos + n]).decode("utf-8")
+        self.pos += n
+        return s
+
+    # Block types, value types and heap types all share the s33 encoding; the reference type
+    # shorthands carry an extra heap type.
+    def value_type(self):
+        if self.sleb() in REF_TYPES_WITH_HEAP_TYPE:
+            self.sleb()
+
+    def memarg(self):
+        align = self.uleb()
+
+        if align & 0x40:
+            self.uleb()
+
+        self.uleb()
+
+
+def skip_gc_instr(r):
+    op = r.uleb()
+
+    if op in (0, 1, 6, 7, 11, 12, 13, 14, 16):
+        r.uleb()
+    elif op in (2, 3, 4, 5, 8, 9, 10, 17, 18, 19):
+        r.uleb()
+        r.uleb()
+    elif op in (20, 21, 22, 23):
+        r.sleb()
+    elif op in (24, 25):
+        r.byte()
+        r.uleb()
+        r.sleb()
+        r.sleb()
+    elif op != 15 and not 26 <= op <= 30:
+        raise ValueError(f"unknown GC opcode 0xfb {op}")
+
+
+def skip_misc_instr(r):
+    op = r.uleb()
+
+    if op in (8, 10, 12, 14):
+        r.uleb()
+        r.uleb()
+    elif op in (9, 11, 13, 15, 16, 17):
+        r.uleb()
+    elif op > 7:
+        raise ValueError(f"unknown misc opcode 0xfc {op}")
+
+
+def skip_simd_instr(r):
+    op = r.uleb()
+
+    if op <= 11 or op in (92, 93):
+        r.memarg()
+    elif op in (12, 13):
+        r.skip(16)
+    elif 21 <= op <= 34:
+        r.skip(1)
+    elif 84 <= op <= 91:
+        r.memarg()
+        r.skip(1)
+    elif op > 0x113:
+        raise ValueError(f"unknown SIMD opcode 0xfd {op}")
+
+
+def skip_atomic_instr(r):
+    op = r.uleb()
+
+    if op == 3:
+        r.skip(1)
+    elif op <= 2 or 0x10 <= op <= 0x4E:
+        r.memarg()
+    else:
+        raise ValueError(f"unknown atomic opcode 0xfe {op}")
+
+
+def count_calls_in_body(r, wasi_funcs):
+    calls = 0
+
+    for _ in range(r.uleb()):
+        r.uleb()
+        r.value_type()
+
+    while r.pos < r.end:
+        op = r.byte()
+
+        if op == OP_CALL:
+            if r.uleb() in wasi_funcs:
+                calls += 1
+        elif op in (0x02, 0x03, 0x04, 0x06):
+            r.value_type()
+        elif op in (0x07, 0x08, 0x09, 0x0C, 0x0D, 0x12, 0x14, 0x15, 0x18, 0xD2, 0xD5, 0xD6):
+            r.uleb()
+        elif 0x20 <= op <= 0x26 or op in (0x3F, 0x40):
+            r.uleb()
+        elif op == 0x0E:
+            for _ in range(r.uleb() + 1):
+                r.uleb()
+        elif op in (0x11, 0x13):
+            r.uleb()
+            r.uleb()
+        elif op == 0x1C:
+            for _ in range(r.uleb()):
+                r.value_type()
+        elif op == 0x1F:
+            r.value_type()
+
+            for _ in range(r.uleb()):
+                if r.byte() in (0x00, 0x01):
+                    r.uleb()
+
+                r.uleb()
+        elif 0x28 <= op <= 0x3E:
+            r.memarg()
+        elif op in (0x41, 0x42):
+            r.sleb()
+        elif op == 0x43:
+            r.skip(4)
+        elif op == 0x44:
+            r.skip(8)
+        elif op == 0xD0:
+            r.sleb()
+        elif op == 0xFB:
+            skip_gc_instr(r)
+        elif op == 0xFC:
+            skip_misc_instr(r)
+        elif op == 0xFD:
+            skip_simd_instr(r)
+        elif op == 0xFE:
+            skip_atomic_instr(r)
+        elif op not in OPS_WITHOUT_IMMEDIATES and not 0x45 <= op <= 0xC4:
+            raise ValueError(f"unknown opcode {op:#x}")
+
+    if r.pos != r.end:
+        raise ValueError("function body overruns its declared size")
+
+    return calls
+
+
+def wasi_named_funcs(r):
+    funcs = set()
+
+    while r.pos < r.end:
+        subsection_id = r.byte()
+        subsection_size = r.uleb()
+        subsection_end = r.pos + subsection_size
+
+        if subsection_id == NAME_SUBSECTION_FUNCTIONS:
+            for _ in range(r.uleb()):
+                func_idx = r.uleb()
+
+                if r.name().startswith(WASI_IMPORT_PREFIX):
+                    funcs.add(func_idx)
+
+        r.pos = subsection_end
+
+    return funcs
+
+
+def count_calls(wasm_file):
+    with open(wasm_file, "rb") as f:
+        data = memoryview(f.read())
+
+    if data[:4] != WASM_MAGIC:
+        raise ValueError("not a wasm module")
+
+    if data[4:8] != WASM_CORE_VERSION:
+        raise ValueError(f"not a core wasm module (version {bytes(data[4:8]).hex()})")
+
+    r = Reader(data, 8)
+    wasi_funcs = set()
+    code = None
+
+    # The name section follows the code section, so collect both before counting.
+    while r.pos < r.end:
+        section_id = r.byte()
+        section_size = r.uleb()
+        section_end = r.pos + section_size
+
+        if section_end > r.end:
+            raise ValueError(f"section {section_id} overruns the module")
+
+        if section_id == SECTION_CUSTOM:
+            custom = Reader(data, r.pos, section_end)
+
+            if custom.name() == "name":
+                wasi_funcs = wasi_named_funcs(custom)
+        elif section_id == SECTION_CODE:
+            code = Reader(data, r.pos, section_end)
+
+        r.pos = section_end
+
+    calls = 0
+
+    if code is None or not wasi_funcs:
+        return calls
+
+    for _ in range(code.uleb()):
+        body_size = code.uleb()
+        calls += count_calls_in_body(Reader(data, code.pos, code.pos + body_size), wasi_funcs)
+        code.skip(body_size)
+
+    return calls
+
+
+def count_calls_or_skip(wasm_file):
+    try:
+        return count_calls(wasm_file)
+    except (OSError, ValueError, IndexError) as e:
+        print(f"skipping {wasm_file}: {e}", file=sys.stderr)
+
+        return 0
+
+
+if __name__ == "__main__":
+    wasm_files = glob(sys.argv[1])
+
+    with ProcessPoolExecutor() as executor:
+        print(sum(executor.map(count_calls_or_skip, wasm_files)))